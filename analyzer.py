@@ -14,23 +14,70 @@ from __future__ import annotations
 
 import argparse
 import datetime as dt
-import io
+import functools
+import gzip
+import html
+import itertools
+import json
+import multiprocessing.util
 import os
+import queue
+import re
+import shutil
+import sqlite3
+import struct
 import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, as_completed, wait
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
 
 import berserk
 import chess
 import chess.engine
-import chess.pgn
+import chess.polyglot
+import chess.svg
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import brotli  # необязательная зависимость: .br рядом с отчётом
+except ImportError:
+    brotli = None
 
 
 # ----------------------------- утилиты ----------------------------------------
 
 def env(name: str, default: Optional[str] = None) -> Optional[str]:
-    v = os.environ.get(name)
-    return default if v in (None, "") else v
+    return os.environ.get(name) or default
+
+
+# значения CLI по умолчанию из окружения — читаются один раз при импорте модуля
+_MAX_GAMES_DEFAULT = int(env("MAX_GAMES", "10"))
+_DEPTH_DEFAULT = int(env("DEPTH", "12"))
+_MIN_CP_DEFAULT = int(env("MIN_CP", "50"))
+_MISTAKE_DEFAULT = int(env("MISTAKE", "150"))
+_BLUNDER_DEFAULT = int(env("BLUNDER", "300"))
+_TOKEN_DEFAULT = env("LICHESS_TOKEN", "")
+_HASH_PER_WORKER_MB = 128
+
+# минимальный разбор PGN: Lichess отдаёт плоскую основную линию без часов и оценок
+# в значениях тегов кавычка и обратный слеш экранируются обратным слешем (стандарт PGN)
+_PGN_HEADER_RE = re.compile(r'^\[(\w+)\s+"((?:[^"\\]|\\.)*)"\]\s*$', re.M)
+_PGN_ESCAPE_RE = re.compile(r"\\(.)")
+_PGN_COMMENT_RE = re.compile(r"\{[^}]*\}|;[^\n]*")
+_PGN_VARIATION_RE = re.compile(r"\([^()]*\)")
+_PGN_NOISE_RE = re.compile(r"\$\d+|\d+\.(?:\.\.)?|[?!]+")
+_PGN_RESULTS = frozenset(("1-0", "0-1", "1/2-1/2", "*"))
+# варианты, которые умеют и python-chess (chess.Board), и Stockfish в обычном режиме
+_ANALYZED_VARIANTS = frozenset(("standard", "chess960", "from position"))
+
+
+def default_cache_path() -> Path:
+    # вне out/: каталог отчёта публикуется целиком (GitHub Pages)
+    base = env("XDG_CACHE_HOME") or str(Path.home() / ".cache")
+    return Path(base) / "tactikcheck" / "evals.sqlite"
 
 
 def to_millis(date_str: str) -> int:
@@ -38,27 +85,405 @@ def to_millis(date_str: str) -> int:
     return int(d.timestamp() * 1000)
 
 
-def score_to_cp(score: chess.engine.PovScore) -> int:
-    if score.is_mate():
-        m = score.mate()
-        return 100000 if (m and m > 0) else -100000
-    return int(score.score(mate_score=100000))
+def score_to_cp(score: chess.engine.Score) -> int:
+    mate = score.mate()
+    if mate is not None:
+        return 100000 if mate > 0 else -100000
+    # не мат — cp уже целое, mate_score не нужен
+    return score.score()
+
+
+def pgn_headers(pgn_text: str) -> Dict[str, str]:
+    return {
+        tag: _PGN_ESCAPE_RE.sub(r"\1", value) if "\\" in value else value
+        for tag, value in _PGN_HEADER_RE.findall(pgn_text)
+    }
+
+
+def pgn_sans(pgn_text: str) -> List[str]:
+    """SAN основной линии без построения дерева chess.pgn."""
+    movetext = _PGN_HEADER_RE.sub("", pgn_text)
+    # экспорт Lichess без clocks/evals обычно не содержит ни комментариев, ни
+    # вариантов — проходы регулярками по ним запускаются только при необходимости
+    if "{" in movetext or ";" in movetext:
+        movetext = _PGN_COMMENT_RE.sub(" ", movetext)
+    # варианты могут быть вложенными — снимаем изнутри наружу
+    while "(" in movetext:
+        stripped = _PGN_VARIATION_RE.sub(" ", movetext)
+        if stripped == movetext:
+            break
+        movetext = stripped
+    movetext = _PGN_NOISE_RE.sub(" ", movetext)
+    return [tok for tok in movetext.split() if tok not in _PGN_RESULTS]
 
 
-def classify(delta: int, thresholds: Dict[str, int]) -> Optional[str]:
-    if delta >= thresholds["blunder"]:
-        return "blunder"
-    if delta >= thresholds["mistake"]:
-        return "mistake"
-    if delta >= thresholds["inaccuracy"]:
-        return "inaccuracy"
-    return None
+def start_board(headers: Dict[str, str]) -> chess.Board:
+    fen = headers.get("FEN")
+    if not fen:
+        return chess.Board()
+    return chess.Board(fen, chess960=headers.get("Variant", "").lower() == "chess960")
+
+
+def has_choice(board: chess.Board) -> bool:
+    # генерация ходов останавливается на втором легальном — полный список не нужен
+    return next(itertools.islice(board.legal_moves, 1, None), None) is not None
 
 
 def lichess_ply_link(game_id: str, ply: int) -> str:
     return f"https://lichess.org/{game_id}#{ply}"
 
 
+# ----------------------------- кэш оценок -------------------------------------
+
+class EvalCache:
+    """Оценки позиций на диске между запусками: zobrist -> лучший ход и cp по глубинам.
+
+    Запрос на глубине d обслуживает любая запись с глубиной >= d (берётся самая
+    глубокая). Рядом лежат готовые результаты целых партий — по id партии и отпечатку
+    настроек анализа. SQLite в режиме WAL: в него одновременно пишут все воркеры
+    пула, у каждого процесса своё соединение. Соединение в autocommit: каждая запись —
+    отдельная короткая транзакция, блокировка на запись держится только на время
+    самой записи (иначе воркер, анализирующий партию минутами, запирал бы кэш для остальных).
+    """
+
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path), timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # воркеры открывают кэш одновременно — миграция схемы в одной транзакции
+        self.conn.execute("BEGIN IMMEDIATE")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            # прежняя схема держала глубину внутри ключа — такие записи просто сбрасываются
+            self.conn.execute("DROP TABLE IF EXISTS best")
+            self.conn.execute("DROP TABLE IF EXISTS moves")
+            self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS best ("
+            "pos BLOB NOT NULL, depth INTEGER NOT NULL, uci TEXT NOT NULL, cp INTEGER NOT NULL, "
+            "PRIMARY KEY (pos, depth))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS moves ("
+            "pos BLOB NOT NULL, depth INTEGER NOT NULL, uci TEXT NOT NULL, cp INTEGER NOT NULL, "
+            "PRIMARY KEY (pos, depth, uci))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS games ("
+            "game_id TEXT NOT NULL, settings TEXT NOT NULL, data BLOB NOT NULL, "
+            "PRIMARY KEY (game_id, settings))"
+        )
+        self.conn.execute("COMMIT")
+
+    @staticmethod
+    def key(board: chess.Board, nodes: Optional[int] = None) -> bytes:
+        # лимит узлов — часть ключа: оценки с ним и без него несравнимы по глубине
+        return struct.pack(">QI", chess.polyglot.zobrist_hash(board), nodes or 0)
+
+    def get(self, pos: bytes, depth: int, played_uci: str) -> Optional[Tuple[int, str, int]]:
+        rows = self.conn.execute(
+            "SELECT b.uci, b.cp, m.cp FROM best b "
+            "LEFT JOIN moves m ON m.pos = b.pos AND m.depth = b.depth AND m.uci = ? "
+            "WHERE b.pos = ? AND b.depth >= ? ORDER BY b.depth DESC",
+            (played_uci, pos, depth),
+        )
+        for best_uci, best_cp, played_cp in rows:
+            if played_uci == best_uci:
+                return best_cp, best_uci, best_cp
+            if played_cp is not None:
+                return best_cp, best_uci, played_cp
+        return None
+
+    def put(self, pos: bytes, depth: int, best_uci: str, best_cp: int, played_uci: str, played_cp: int) -> None:
+        # лучший ход и сыгранный — одной транзакцией; с WAL и synchronous=NORMAL это дёшево
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute("INSERT OR REPLACE INTO best VALUES (?, ?, ?, ?)", (pos, depth, best_uci, best_cp))
+            if played_uci != best_uci:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO moves VALUES (?, ?, ?, ?)", (pos, depth, played_uci, played_cp)
+                )
+
+    def get_game(self, game_id: str, settings: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute(
+            "SELECT data FROM games WHERE game_id = ? AND settings = ?", (game_id, settings)
+        ).fetchone()
+        if not row:
+            return None
+        # битая или старая (не JSON) запись — обычный промах, партия разберётся заново
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            return None
+
+    def put_game(self, game_id: str, settings: str, result: Dict[str, Any]) -> None:
+        # в кэш идут только простые данные: снимок доски не сохраняется,
+        # при попадании он восстанавливается из fen_before
+        data = dict(result, errors=[{k: v for k, v in e.items() if k != "board"} for e in result["errors"]])
+        self.conn.execute(
+            "INSERT OR REPLACE INTO games VALUES (?, ?, ?)", (game_id, settings, json.dumps(data))
+        )
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+# ----------------------------- анализ партии ----------------------------------
+
+class GameAnalyzer:
+    """Один процесс Stockfish и анализ партий; по экземпляру на воркер пула."""
+
+    def __init__(
+        self,
+        stockfish_path: str,
+        depth: int = 14,
+        threads: int = 1,
+        hash_mb: int = 512,
+        thresholds: Dict[str, int] = None,
+        min_cp_show: int = 50,
+        opening_skip_plies: int = 8,
+        cache_path: Optional[str] = None,
+        nodes: Optional[int] = None,
+        screen_depth: int = 10,
+        multipv: int = 2,
+        screen_margin: Optional[int] = None,
+        skip_pieces: int = 0,
+    ):
+        self.stockfish_path = stockfish_path
+        self.depth = depth
+        self.nodes = nodes
+        self.multipv = max(1, multipv)
+        self.screen_depth = screen_depth
+        self.threads = threads
+        self.hash_mb = hash_mb
+        self.thresholds = thresholds or {"inaccuracy": 50, "mistake": 150, "blunder": 300}
+        self.min_cp_show = min_cp_show
+        # насколько неглубокий отсев может недооценить потерю: ход, потерявший на
+        # screen_depth не больше min_cp_show - screen_margin, полной глубины не получает
+        self.screen_margin = min_cp_show // 2 if screen_margin is None else screen_margin
+        self.opening_skip_plies = opening_skip_plies
+        # эндшпили с <= skip_pieces фигурами (вместе с королями) не анализируются; 0 — выкл.
+        self.skip_pieces = skip_pieces
+        self.cache = EvalCache(Path(cache_path)) if cache_path else None
+        self.engine: Optional[chess.engine.SimpleEngine] = None
+        self._settings: Optional[str] = None
+        # лимиты поиска по глубине (отсев и полная) — создаются один раз
+        self._limits: Dict[int, chess.engine.Limit] = {}
+
+    def _eng(self) -> chess.engine.SimpleEngine:
+        if self.engine is None:
+            self.engine = chess.engine.SimpleEngine.popen_uci(self.stockfish_path)
+            # все setoption уходят одной пачкой без isready между ними, затем один
+            # isready — воркер ждёт готовности движка ровно один раз
+            options: Dict[str, Any] = {"Threads": self.threads, "Hash": self.hash_mb}
+            if "UCI_AnalyseMode" in self.engine.options:
+                options["UCI_AnalyseMode"] = True
+            self.engine.configure(options)
+            self.engine.ping()
+        return self.engine
+
+    def settings_key(self) -> str:
+        """Отпечаток движка и настроек анализа, от которых зависит результат партии.
+
+        Движок опознаётся по файлу (путь, размер, mtime), а не по UCI id — попадание в кэш
+        не запускает Stockfish, а обновление бинарника делает старые партии промахом.
+        """
+        if self._settings is None:
+            binary = os.path.realpath(shutil.which(self.stockfish_path) or self.stockfish_path)
+            try:
+                st = os.stat(binary)
+                engine = (binary, st.st_size, st.st_mtime_ns)
+            except OSError:
+                engine = (binary,)
+            self._settings = repr((
+                engine, self.depth, self.nodes, self.multipv,
+                self.screen_depth, self.screen_margin, sorted(self.thresholds.items()),
+                self.min_cp_show, self.opening_skip_plies, self.skip_pieces,
+            ))
+        return self._settings
+
+    def close(self):
+        try:
+            if self.engine:
+                self.engine.quit()
+        except Exception:
+            pass
+        self.engine = None
+        if self.cache:
+            self.cache.close()
+            self.cache = None
+
+    def classify(self, delta: int) -> Optional[str]:
+        # от самой тяжёлой категории к лёгкой: при равных или перепутанных порогах
+        # побеждает более тяжёлая; вызывается только для ходов, попадающих в отчёт
+        t = self.thresholds
+        if delta >= t["blunder"]:
+            return "blunder"
+        if delta >= t["mistake"]:
+            return "mistake"
+        if delta >= t["inaccuracy"]:
+            return "inaccuracy"
+        return None
+
+    def _evaluate(
+        self, board: chess.Board, move: chess.Move, depth: int, gkey: object
+    ) -> Tuple[int, str, int]:
+        """(best_cp, best_uci, played_cp) с точки зрения стороны, делающей ход."""
+        # глубина и лимит узлов: поиск останавливается по тому, что наступит раньше
+        limit = self._limits.get(depth)
+        if limit is None:
+            limit = self._limits[depth] = chess.engine.Limit(depth=depth, nodes=self.nodes)
+        pos = EvalCache.key(board, self.nodes) if self.cache else None
+        if pos is not None:
+            hit = self.cache.get(pos, depth, move.uci())
+            if hit:
+                return hit
+
+        eng = self._eng()
+        # один поиск с MultiPV=K: лучший ход (голова PV) + его оценка, а сыгранный ход
+        # часто оказывается одной из K линий — тогда второй поиск не нужен;
+        # .relative — оценка уже со стороны делающего ход, без пересчёта через pov()
+        infos = eng.analyse(board, limit=limit, multipv=self.multipv, game=gkey)
+        best_cp = score_to_cp(infos[0]["score"].relative)
+        best_move = infos[0]["pv"][0]
+
+        played_cp: Optional[int] = None
+        for info in infos:
+            if info.get("pv") and info["pv"][0] == move:
+                played_cp = score_to_cp(info["score"].relative)
+                break
+        if played_cp is None:
+            # сыгранный ход вне топ-K — отдельный поиск только по нему на той же глубине
+            # (TT уже прогрет поиском выше); multipv тот же, чтобы python-chess не
+            # переключал MultiPV туда-обратно лишним setoption
+            info_played = eng.analyse(board, limit=limit, multipv=self.multipv, root_moves=[move], game=gkey)[0]
+            played_cp = score_to_cp(info_played["score"].relative)
+
+        if pos is not None:
+            self.cache.put(pos, depth, best_move.uci(), best_cp, move.uci(), played_cp)
+        return best_cp, best_move.uci(), played_cp
+
+    def analyze_pgn(self, pgn_text: str) -> Optional[Dict[str, Any]]:
+        """Разбор партии; None — партия пропущена (вариант, который не анализируется)."""
+        headers = pgn_headers(pgn_text)
+        # неподдерживаемый вариант (atomic, crazyhouse, …) отбрасываем по одним
+        # заголовкам — ходы партии не разбираются вовсе, в статистику она не попадает
+        if headers.get("Variant", "Standard").lower() not in _ANALYZED_VARIANTS:
+            return None
+        gid = (headers.get("LichessURL") or headers.get("Site", "")).rpartition("/")[2]
+        meta = {
+            "game_id": gid,
+            "white": headers.get("White", "?"),
+            "black": headers.get("Black", "?"),
+            "white_elo": headers.get("WhiteElo"),
+            "black_elo": headers.get("BlackElo"),
+            "date": headers.get("UTCDate", headers.get("Date", "")),
+            "time_control": headers.get("TimeControl", ""),
+            "opening": headers.get("Opening", ""),
+            "errors": [],
+        }
+        # партия уже разобрана с теми же настройками (пересекающиеся периоды выгрузки) —
+        # движок не нужен вовсе
+        if self.cache and gid:
+            hit = self.cache.get_game(gid, self.settings_key())
+            if hit is not None:
+                chess960 = start_board(headers).chess960
+                try:
+                    for e in hit["errors"]:
+                        e["board"] = chess.Board(e["fen_before"], chess960=chess960)
+                    return hit
+                except (KeyError, TypeError, ValueError):
+                    pass  # запись не той формы — как промах, партия разбирается заново
+
+        # сначала разворачиваем основную линию вперёд: (ply, доска до хода, ход);
+        # дебютные ходы, вынужденные ответы (единственный легальный ход) и, по желанию,
+        # эндшпили с малым числом фигур не тренируют ничего полезного — движок на них не тратим
+        plies: List[Tuple[int, chess.Board, chess.Move]] = []
+        board = start_board(headers)
+        for ply, san in enumerate(pgn_sans(pgn_text), 1):
+            move = board.parse_san(san)
+            if (
+                ply > self.opening_skip_plies
+                and chess.popcount(board.occupied) > self.skip_pieces
+                and has_choice(board)
+            ):
+                # снимок без стека ходов: копия расстановки за O(1), без FEN туда-обратно
+                plies.append((ply, board.copy(stack=False), move))
+            board.push(move)
+
+        # поэтапная глубина: сначала дешёвый отсев на screen_depth, полную глубину
+        # получают только ходы, где отсев увидел заметную потерю
+        screen_depth = min(self.screen_depth, self.depth)
+        # ucinewgame уходит только при смене партии (python-chess сравнивает game),
+        # между ходами одной партии хеш-таблица Stockfish остаётся тёплой
+        gkey = gid or pgn_text
+
+        # анализ с конца партии к началу (трюк ChessMaster/Fritz): поддерево
+        # позиции N-1 почти целиком лежит в TT после поиска позиции N
+        errors: List[Dict[str, Any]] = []
+        for ply, board, move in reversed(plies):
+            side_to_move = board.turn
+            if screen_depth < self.depth:
+                best_cp, _, played_cp = self._evaluate(board, move, screen_depth, gkey)
+                if best_cp - played_cp <= self.min_cp_show - self.screen_margin:
+                    continue
+            best_cp, best_move_uci, played_cp = self._evaluate(board, move, self.depth, gkey)
+
+            # большинство ходов отсекается одним сравнением, до классификации
+            delta = best_cp - played_cp
+            if delta < self.min_cp_show:
+                continue
+            label = self.classify(delta)
+            if not label:
+                continue
+            errors.append({
+                "ply": ply,
+                "move_no": (ply + 1) // 2,
+                "who": "white" if side_to_move == chess.WHITE else "black",
+                "san": board.san(move),
+                "cp_loss": delta,
+                "category": label,
+                "fen_before": board.fen(),
+                # снимок позиции — диаграмма рисуется по нему без разбора FEN
+                "board": board,
+                "best_uci": best_move_uci,
+                "link": lichess_ply_link(gid, ply),
+            })
+
+        errors.reverse()
+        meta["errors"] = errors
+        if self.cache and gid:
+            self.cache.put_game(gid, self.settings_key(), meta)
+        return meta
+
+
+# ----------------------------- пул воркеров -----------------------------------
+
+# у каждого процесса пула свой Stockfish (Threads=1): независимые движки на разных
+# партиях масштабируются почти линейно, в отличие от lazy SMP внутри одного поиска
+_WORKER: Optional[GameAnalyzer] = None
+
+
+def _init_worker(cfg: Dict[str, Any]) -> None:
+    global _WORKER
+    _WORKER = GameAnalyzer(**cfg)
+    # atexit в дочерних процессах multiprocessing не срабатывает, Finalize — да
+    multiprocessing.util.Finalize(None, _WORKER.close, exitpriority=10)
+
+
+def _analyze_pgn_worker(pgn_text: str) -> Optional[Dict[str, Any]]:
+    result = _WORKER.analyze_pgn(pgn_text)
+    if result is None:
+        return None
+    # диаграммы рисуются тут же, в процессе пула, — параллельно с анализом других
+    # партий; в главный процесс уходит готовая строка SVG вместо доски
+    for e in result["errors"]:
+        e["svg"] = board_svg(e.pop("board"), chess.WHITE if e["who"] == "white" else chess.BLACK)
+    return result
+
+
 # ----------------------------- анализатор -------------------------------------
 
 class Analyzer:
@@ -73,10 +498,20 @@ class Analyzer:
         perf: Optional[List[str]] = None,
         stockfish_path: Optional[str] = None,
         depth: int = 14,
-        threads: int = 2,
-        hash_mb: int = 256,
+        threads: int = 1,
+        hash_mb: Optional[int] = None,
         thresholds: Dict[str, int] = None,
         min_cp_show: int = 50,
+        opening_skip_plies: int = 8,
+        workers: int = 0,
+        cache_path: Optional[str] = None,
+        nodes: Optional[int] = None,
+        multipv: int = 2,
+        screen_depth: int = 10,
+        screen_margin: Optional[int] = None,
+        verify_user: bool = False,
+        skip_pieces: int = 0,
+        color: Optional[str] = None,
     ):
         self.user = user
         self.token = token
@@ -91,43 +526,75 @@ class Analyzer:
         self.hash_mb = hash_mb
         self.thresholds = thresholds or {"inaccuracy": 50, "mistake": 150, "blunder": 300}
         self.min_cp_show = min_cp_show
+        self.opening_skip_plies = opening_skip_plies
         self.stockfish_path = stockfish_path or env("STOCKFISH_PATH", "stockfish")
-        self.client = self._make_client()
-        self.engine: Optional[chess.engine.SimpleEngine] = None
+        # по умолчанию ядра делятся между воркерами: workers * threads ~ число CPU
+        self.workers = workers or max(1, (os.cpu_count() or 1) // max(1, threads))
+        self.cache_path = cache_path
+        self.nodes = nodes
+        self.multipv = multipv
+        self.screen_depth = screen_depth
+        self.screen_margin = screen_margin
+        self.verify_user = verify_user
+        self.skip_pieces = skip_pieces
+        self.color = color
+        self.session = self._make_session()
+        self.client = berserk.Client(session=self.session)
 
     # --- infra
 
-    def _make_client(self):
-        if self.token:
-            session = berserk.TokenSession(self.token)
-            return berserk.Client(session=session)
-        return berserk.Client()
-
-    def _eng(self) -> chess.engine.SimpleEngine:
-        if self.engine is None:
-            self.engine = chess.engine.SimpleEngine.popen_uci(self.stockfish_path)
-            self.engine.configure({"Threads": self.threads, "Hash": self.hash_mb})
-        return self.engine
-
-    def close(self):
-        try:
-            if self.engine:
-                self.engine.quit()
-        except Exception:
-            pass
+    def _make_session(self) -> requests.Session:
+        # одна keep-alive сессия на все запросы к Lichess: и проверка пользователя,
+        # и выгрузка партий через berserk идут по уже открытому TLS-соединению
+        session = berserk.TokenSession(self.token) if self.token else requests.Session()
+        # 429 и 502/503 Lichess отдаёт при перегрузке/лимите — повторяем с паузой из
+        # Retry-After; после исчерпания попыток ответ уходит дальше как есть, и ошибку
+        # поднимает raise_for_status/berserk, а не RetryError из глубины urllib3
+        retry = Retry(
+            total=5,
+            backoff_factor=1,
+            status_forcelist=(429, 502, 503),
+            allowed_methods=frozenset(("GET", "HEAD")),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+        return session
+
+    def engine_config(self) -> Dict[str, Any]:
+        return dict(
+            stockfish_path=self.stockfish_path,
+            depth=self.depth,
+            threads=self.threads,
+            # --hash-mb — общий бюджет памяти, каждый воркер получает свою долю; без него
+            # у каждого воркера своя TT фиксированного размера — поиск на глубине 12–16
+            # (несколько миллионов узлов) в ней помещается, сколько бы ядер ни было
+            hash_mb=max(16, self.hash_mb // self.workers) if self.hash_mb else _HASH_PER_WORKER_MB,
+            thresholds=self.thresholds,
+            min_cp_show=self.min_cp_show,
+            opening_skip_plies=self.opening_skip_plies,
+            cache_path=self.cache_path,
+            nodes=self.nodes,
+            multipv=self.multipv,
+            screen_depth=self.screen_depth,
+            screen_margin=self.screen_margin,
+            skip_pieces=self.skip_pieces,
+        )
 
     # --- загрузка
 
     def _assert_user_exists(self):
-        import urllib.request, json
         url = f"https://lichess.org/api/user/{self.user}"
-        req = urllib.request.Request(url, headers={"User-Agent": "tactikcheck"})
-        with urllib.request.urlopen(req, timeout=20) as r:
-            data = json.loads(r.read().decode("utf-8"))
-        assert "username" in data, "User not found"
-
-    def fetch_pgns(self) -> List[str]:
-        self._assert_user_exists()
+        # для проверки существования хватает статуса: HEAD без тела профиля
+        r = self.session.head(url, headers={"User-Agent": "tactikcheck"}, timeout=10)
+        assert r.status_code != 404, "User not found"
+        r.raise_for_status()
+
+    def iter_pgns(self) -> Iterator[str]:
+        # отдельный запрос профиля — только по --verify-user: несуществующего
+        # пользователя и так выдаёт 404 самой выгрузки, без лишнего round-trip
+        if self.verify_user:
+            self._assert_user_exists()
         params = dict(
             max=self.max_games,
             moves=True,
@@ -143,149 +610,260 @@ class Analyzer:
         if self.perf:
             # berserk ждёт perf_type
             params["perf_type"] = ",".join(self.perf)
+        if self.color:
+            # отбор по цвету делает сам Lichess: лишние партии не скачиваются и не
+            # занимают места в --max-games
+            params["color"] = self.color
 
         print(f"Downloading games for {self.user} (max={self.max_games})...", file=sys.stderr)
-        it = self.client.games.export_by_player(self.user, **params)
-        out: List[str] = []
-        for pgn in it:
-            if not pgn:
-                continue
-            out.append(pgn if isinstance(pgn, str) else pgn.get("pgn", ""))
-        print(f"Got {len(out)} PGNs.", file=sys.stderr)
-        return out
+        # berserk читает ответ потоком и отдаёт по одной партии (as_pgn=True -> str),
+        # здесь они тоже не копятся — сразу уходят в пул анализа
+        count = 0
+        try:
+            for pgn in self.client.games.export_by_player(self.user, **params):
+                if not pgn:
+                    continue
+                count += 1
+                yield pgn
+        except berserk.exceptions.ResponseError as e:
+            assert e.status_code != 404, "User not found"
+            raise
+        print(f"Got {count} PGNs.", file=sys.stderr)
 
     # --- анализ
 
-    def analyze_pgn(self, pgn_text: str) -> Dict[str, Any]:
-        game = chess.pgn.read_game(io.StringIO(pgn_text))
-        headers = game.headers
-        gid = headers.get("LichessURL", "").split("/")[-1] or headers.get("Site", "").split("/")[-1]
-        meta = {
-            "game_id": gid,
-            "white": headers.get("White", "?"),
-            "black": headers.get("Black", "?"),
-            "white_elo": headers.get("WhiteElo"),
-            "black_elo": headers.get("BlackElo"),
-            "date": headers.get("UTCDate", headers.get("Date", "")),
-            "time_control": headers.get("TimeControl", ""),
-            "opening": headers.get("Opening", ""),
-            "errors": [],
-        }
-
-        board = game.board()
-        node = game
-        ply = 0
-        eng = self._eng()
-        limit = chess.engine.Limit(depth=self.depth)
-
-        while not node.is_end():
-            node = node.variation(0)
-            move = node.move
-            side_to_move = board.turn
-            ply += 1
-
-            # оценка лучшего + сам лучший ход (UCI)
-            info_best = eng.analyse(board, limit=limit)
-            best_cp = score_to_cp(info_best["score"].pov(side_to_move))
-            best_move_uci = eng.play(board, limit=limit).move.uci()
-
-            # оценка сыгранного
-            info_played = eng.analyse(board, limit=limit, root_moves=[move])
-            played_cp = score_to_cp(info_played["score"].pov(side_to_move))
-
-            delta = best_cp - played_cp
-            label = classify(delta, self.thresholds)
-            if label and delta >= self.min_cp_show:
-                fen_before = board.fen()
-                san = node.san()
-                who = "white" if side_to_move == chess.WHITE else "black"
-                meta["errors"].append({
-                    "ply": ply,
-                    "move_no": (ply + 1) // 2,
-                    "who": who,
-                    "san": san,
-                    "cp_loss": delta,
-                    "category": label,
-                    "fen_before": fen_before,
-                    "best_uci": best_move_uci,
-                    "link": lichess_ply_link(gid, ply),
-                })
-
-            board.push(move)
+    def analyze_all(self, pgns: Iterable[str]) -> List[Dict[str, Any]]:
+        # загрузка идёт в отдельном потоке и перекрывается с работой Stockfish;
+        # ограниченная очередь и лимит партий «в работе» держат память O(воркеров)
+        q: "queue.Queue[Optional[str]]" = queue.Queue(maxsize=4)
+        failure: List[BaseException] = []
 
-        return meta
+        def produce():
+            try:
+                for pgn in pgns:
+                    q.put(pgn)
+            except BaseException as e:
+                failure.append(e)
+            finally:
+                q.put(None)
+
+        threading.Thread(target=produce, name="pgn-download", daemon=True).start()
+
+        results: Dict[int, Dict[str, Any]] = {}
+        pending: Dict[Future, int] = {}
+        submitted = finished = 0
+
+        def collect(done: Iterable[Future]):
+            nonlocal finished
+            for fut in done:
+                idx = pending.pop(fut)
+                finished += 1
+                try:
+                    result = fut.result()
+                    if result is None:
+                        print(f"[{finished}/{submitted}] Skipped game #{idx + 1} (unsupported variant)", file=sys.stderr)
+                        continue
+                    results[idx] = result
+                    print(f"[{finished}/{submitted}] Analyzed game #{idx + 1}", file=sys.stderr)
+                except Exception as e:
+                    print(f"[{finished}/{submitted}] Skipped game #{idx + 1} due to error: {e}", file=sys.stderr)
+
+        # поток загрузки уже работает (держит сокеты и блокировки requests/urllib3) —
+        # fork() скопировал бы его состояние в воркеры; forkserver порождает их из
+        # чистого однопоточного процесса (на Windows его нет, там и так spawn)
+        methods = multiprocessing.get_all_start_methods()
+        mp_context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        with ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=mp_context,
+            initializer=_init_worker, initargs=(self.engine_config(),),
+        ) as ex:
+            while True:
+                pgn = q.get()
+                if pgn is None:
+                    break
+                pending[ex.submit(_analyze_pgn_worker, pgn)] = submitted
+                submitted += 1
+                if len(pending) >= 2 * self.workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            collect(as_completed(list(pending)))
+
+        if failure:
+            raise failure[0]
+        # порядок партий как при загрузке, независимо от порядка завершения
+        return [results[i] for i in sorted(results)]
 
     # --- рендер
 
     def render_gallery(self, analyzed: List[Dict[str, Any]]):
         out = self.out_dir
         out.mkdir(parents=True, exist_ok=True)
-        cards: List[Dict[str, Any]] = []
         total_games = len(analyzed)
-        total_errors = 0
+        total_errors = sum(len(g["errors"]) for g in analyzed)
 
+        # страница пишется в файл по частям через буфер 1 МиБ: карточки рендерятся
+        # по одной прямо в файл, ни список карточек, ни страница целиком в памяти не живут
+        with open(out / "index.html", "w", encoding="utf-8", buffering=1 << 20) as fh:
+            self._write_html(fh, self._iter_cards(analyzed), total_games, total_errors)
+        self._write_precompressed(out / "index.html")
+        print(f"Wrote gallery: {out/'index.html'}  ({total_games} games, {total_errors} flagged moves)")
+
+    @staticmethod
+    def _write_precompressed(path: Path):
+        # сжатые копии рядом со страницей: статический хостинг (nginx gzip_static,
+        # S3/CloudFront) отдаёт их как есть, без сжатия на лету
+        data = path.read_bytes()
+        with gzip.GzipFile(path.with_name(path.name + ".gz"), "wb", compresslevel=9, mtime=0) as gz:
+            gz.write(data)
+        br = path.with_name(path.name + ".br")
+        if brotli is not None:
+            br.write_bytes(brotli.compress(data, quality=11))
+        else:
+            # без brotli не оставляем устаревший .br от прошлого запуска
+            br.unlink(missing_ok=True)
+
+    def _iter_cards(self, analyzed: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        # поля партии и SAN стоят в тексте элементов — кавычки там экранировать не нужно;
+        # полный html.escape остаётся только для значения атрибута (href)
+        esc = functools.partial(html.escape, quote=False)
         for g in analyzed:
-            gid = g["game_id"]
+            # всё, что попадает в разметку, экранируется здесь один раз (и поля партии —
+            # один раз на партию), шаблон карточки только подставляет готовые строки
+            game_fields = {
+                "game_id": esc(g["game_id"]),
+                "white": esc(g["white"]), "black": esc(g["black"]),
+                "welo": esc(g["white_elo"] or ""), "belo": esc(g["black_elo"] or ""),
+                "date": esc(g["date"]), "opening": esc(g["opening"]),
+                "tc": esc(g["time_control"]),
+            }
             for e in g["errors"]:
-                total_errors += 1
-                cards.append({
-                    "game_id": gid,
-                    "white": g["white"], "black": g["black"],
-                    "welo": g["white_elo"] or "", "belo": g["black_elo"] or "",
-                    "date": g["date"], "opening": g["opening"], "tc": g["time_control"],
-                    "ply": e["ply"], "move_no": e["move_no"], "san": e["san"],
-                    "who": e["who"], "cp_loss": e["cp_loss"], "category": e["category"],
-                    "fen_before": e["fen_before"], "best_uci": e["best_uci"],
-                    "link": e["link"],
-                })
-
-        html = self._build_html(cards, total_games, total_errors)
-        (out / "index.html").write_text(html, encoding="utf-8")
-        print(f"Wrote gallery: {out/'index.html'}  ({total_games} games, {total_errors} flagged moves)")
+                yield dict(
+                    game_fields,
+                    ply=e["ply"], move_no=e["move_no"], san=esc(e["san"]),
+                    who=e["who"], cp_loss=e["cp_loss"], category=e["category"],
+                    badge=e["category"].upper(), turn="w" if e["who"] == "white" else "b",
+                    fen_before=e["fen_before"], best_uci=e["best_uci"],
+                    link=html.escape(e["link"]),
+                    svg=e["svg"],
+                )
+
+    def _write_html(self, fh: TextIO, cards: Iterable[Dict[str, Any]], total_games: int, total_errors: int):
+        fh.write(PAGE_HEAD_TEMPLATE.format(sprite=SVG_SPRITE, total_games=total_games, total_errors=total_errors))
+        for c in cards:
+            fh.write(CARD_TEMPLATE.format_map(c))
+        fh.write(PAGE_TAIL)
+
+
+# ----------------------------- SVG-доски --------------------------------------
+
+# фигуры, рамка и координаты одинаковы во всех карточках: они один раз лежат в
+# скрытом спрайте страницы, а доска карточки — это <use> рамки и <use> фигур
+
+_SVG_SQUARE = chess.svg.SQUARE_SIZE
+_SVG_MARGIN = 15                                  # поле с координатами, как в chess.svg.board
+_SVG_FULL = 2 * _SVG_MARGIN + 8 * _SVG_SQUARE
+
+
+def _svg_body(svg: str) -> str:
+    return svg[svg.index(">") + 1:svg.rindex("</svg>")]
+
+
+def _svg_sprite() -> str:
+    frames = "".join(
+        f'<g id="frame-{chess.COLOR_NAMES[color]}">{_svg_body(chess.svg.board(orientation=color))}</g>'
+        for color in chess.COLORS
+    )
+    return (
+        '<svg width="0" height="0" style="position:absolute" aria-hidden="true">'
+        f'<defs>{"".join(chess.svg.PIECES.values())}{frames}</defs></svg>'
+    )
+
+
+def _svg_piece_uses() -> Dict[Tuple[chess.Color, chess.Square, chess.Piece], str]:
+    uses = {}
+    for orientation in chess.COLORS:
+        for square in chess.SQUARES:
+            file, rank = chess.square_file(square), chess.square_rank(square)
+            x = (file if orientation else 7 - file) * _SVG_SQUARE + _SVG_MARGIN
+            y = (7 - rank if orientation else rank) * _SVG_SQUARE + _SVG_MARGIN
+            for color in chess.COLORS:
+                for piece_type in chess.PIECE_TYPES:
+                    href = f"#{chess.COLOR_NAMES[color]}-{chess.PIECE_NAMES[piece_type]}"
+                    uses[orientation, square, chess.Piece(piece_type, color)] = (
+                        f'<use href="{href}" transform="translate({x}, {y})"/>'
+                    )
+    return uses
+
+
+SVG_SPRITE = _svg_sprite()
+# готовый <use> для каждой (ориентация, поле, фигура): доска карточки — только склейка строк
+_SVG_PIECE_USES = _svg_piece_uses()
 
-    def _build_html(self, cards: List[Dict[str, Any]], total_games: int, total_errors: int) -> str:
-        # карточки
-        items = []
-        for i, c in enumerate(cards, 1):
-            orient = "white" if c["who"] == "white" else "black"
-            badge = c["category"].upper()
-            items.append(f"""
+
+# одинаковые расстановки (типовые дебютные зевки) рисуются один раз на процесс;
+# ключ — битборды фигур, он на порядки дешевле board_fen()
+_SVG_MEMO: Dict[Tuple[int, ...], str] = {}
+_SVG_MEMO_MAX = 4096
+
+
+def board_svg(board: chess.BaseBoard, orientation: chess.Color = chess.WHITE, size: int = 360) -> str:
+    key = (
+        board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings,
+        board.occupied_co[chess.WHITE], orientation, size,
+    )
+    svg = _SVG_MEMO.get(key)
+    if svg is None:
+        pieces = "".join(_SVG_PIECE_USES[orientation, sq, piece] for sq, piece in board.piece_map().items())
+        svg = (
+            f'<svg viewBox="0 0 {_SVG_FULL} {_SVG_FULL}" width="{size}" height="{size}">'
+            f'<use href="#frame-{chess.COLOR_NAMES[orientation]}"/>{pieces}</svg>'
+        )
+        if len(_SVG_MEMO) < _SVG_MEMO_MAX:
+            _SVG_MEMO[key] = svg
+    return svg
+
+
+# ----------------------------- HTML-шаблоны -----------------------------------
+
+# шаблоны форматируются один раз на страницу / карточку через str.format_map,
+# без пересборки гигантской f-строки вокруг уже готового списка карточек
+
+CARD_TEMPLATE = """
 <div class="card tactic"
-     data-id="{i}"
-     data-fen="{c['fen_before']}"
-     data-best="{c['best_uci']}"
-     data-turn="{ 'w' if c['who']=='white' else 'b' }">
+     data-fen="{fen_before}"
+     data-best="{best_uci}"
+     data-turn="{turn}">
   <div class="head">
-    <span class="tag {c['category']}">{badge}</span>
-    <span class="title">#{c['move_no']} • {c['san']}</span>
+    <span class="tag {category}">{badge}</span>
+    <span class="title">#{move_no} • {san}</span>
   </div>
   <div class="meta">
-    {c['white']} ({c['welo']}) — {c['black']} ({c['belo']})<br/>
-    {c['date']} • {c['opening']} • {c['tc']}
+    {white} ({welo}) — {black} ({belo})<br/>
+    {date} • {opening} • {tc}
   </div>
-  <div class="cp">Δ {c['cp_loss']} cp</div>
-  <div class="link"><a href="{c['link']}" target="_blank" rel="noopener">{c['game_id']}</a></div>
+  <div class="cp">Δ {cp_loss} cp</div>
+  <div class="link"><a href="{link}" target="_blank" rel="noopener">{game_id}</a></div>
 
-  <div class="board-wrap" id="wrap-{i}">
-    <div id="board-{i}" class="board"></div>
+  <div class="board-wrap">
+    <div class="board">{svg}</div>
+    <button class="train" type="button">▶ Тренировать</button>
     <div class="help">Сыграй лучший ход — перетяни фигуру. Ход другой стороны запрещён.</div>
-    <div class="status" id="status-{i}"></div>
-    <button id="ok-{i}" class="ok" style="display:none">✅ Успех!</button>
+    <div class="status"></div>
+    <button class="ok" type="button" style="display:none">✅ Успех!</button>
   </div>
 </div>
-""")
+"""
 
-        # HTML (чистый CDN, заданы pieceTheme с CDN — фигуры точно грузятся)
-        html = f"""<!doctype html>
+# доски отрисованы на сервере (SVG поверх общего спрайта); jQuery + chess.js + chessboard.js с CDN
+# подгружаются только при первом нажатии «Тренировать»
+PAGE_HEAD_TEMPLATE = """<!doctype html>
 <html lang="ru">
 <head>
   <meta charset="utf-8"/>
   <meta name="viewport" content="width=device-width,initial-scale=1"/>
   <title>Lichess Error Gallery + Trainer</title>
-
-  <link rel="stylesheet"
-        href="https://cdnjs.cloudflare.com/ajax/libs/chessboard-js/1.0.0/chessboard-1.0.0.min.css"
-        crossorigin="anonymous"/>
+  <link rel="preconnect" href="https://cdnjs.cloudflare.com" crossorigin/>
+  <link rel="preconnect" href="https://code.jquery.com" crossorigin/>
 
   <style>
     :root {{
@@ -300,6 +878,8 @@ class Analyzer:
     .stats {{ color:var(--muted); font-size:13px }}
     main.grid {{ display:grid; gap:16px; padding:16px; grid-template-columns:repeat(auto-fill,minmax(360px,1fr)) }}
     .card {{ border:1px solid var(--stroke); background:var(--card); border-radius:12px; padding:12px }}
+    /* карточки вне экрана не раскладываются и не рисуются, пока к ним не прокрутят */
+    .card.tactic {{ content-visibility:auto; contain-intrinsic-size:auto 600px }}
     .head {{ display:flex; gap:10px; align-items:center; margin-bottom:6px; font-weight:600 }}
     .tag {{ font-size:12px; text-transform:uppercase; letter-spacing:.6px; padding:2px 8px; border-radius:999px }}
     .tag.inaccuracy {{ background:var(--inacc); color:#000 }}
@@ -308,6 +888,9 @@ class Analyzer:
     .meta, .cp, .link, .help {{ color:var(--muted); font-size:13px; margin-top:6px }}
     .board-wrap {{ margin-top:10px }}
     .board {{ width:360px; max-width:100%; border-radius:8px; overflow:hidden; border:1px solid var(--stroke) }}
+    .board > svg {{ display:block; width:100%; height:auto }}
+    .train {{ margin-top:8px; background:var(--accent); color:#000; border:none; padding:6px 12px; border-radius:8px; cursor:pointer; font-weight:600 }}
+    .train:disabled {{ opacity:.6; cursor:progress }}
     .status {{ margin-top:8px; font-weight:600; min-height:1.2em }}
     .status.good {{ color: var(--good) }}
     .status.bad  {{ color: var(--bad) }}
@@ -323,111 +906,153 @@ class Analyzer:
   </style>
 </head>
 <body>
+  {sprite}
   <header>
     <h1>Ляпы под микроскопом — Error Gallery + Trainer</h1>
     <div class="stats">Просканировано игр: <b>{total_games}</b> • Найдено позиций: <b>{total_errors}</b></div>
-    <div class="stats">Сделай лучший ход на каждой доске. Неверный ход откатится, верный покажет «Успех!».</div>
+    <div class="stats">Нажми «Тренировать» и сделай лучший ход. Неверный ход откатится, верный покажет «Успех!».</div>
   </header>
 
   <main class="grid" id="grid">
-    {''.join(items)}
-  </main>
+"""
 
-  <footer>Отчёт сгенерирован автоматически. Доски интерактивны без перехода на внешние сайты.</footer>
+PAGE_TAIL = """  </main>
 
-  <!-- Зависимости: jQuery (для chessboard.js), chess.js (логика), chessboard.js (доска) -->
-  <script src="https://code.jquery.com/jquery-3.6.0.min.js" crossorigin="anonymous"></script>
-  <script src="https://cdnjs.cloudflare.com/ajax/libs/chess.js/0.13.4/chess.min.js" crossorigin="anonymous"></script>
-  <script src="https://cdnjs.cloudflare.com/ajax/libs/chessboard-js/1.0.0/chessboard-1.0.0.min.js" crossorigin="anonymous"></script>
+  <footer>Отчёт сгенерирован автоматически. Доски интерактивны без перехода на внешние сайты.</footer>
 
   <script>
-  (function() {{
-    function uciToSan(fen, uci) {{
-      try {{
+  (function() {
+    // Зависимости тренажёра: jQuery (для chessboard.js), chess.js (логика), chessboard.js (доска)
+    var CDN = 'https://cdnjs.cloudflare.com/ajax/libs/';
+    var LIBS = [
+      'https://code.jquery.com/jquery-3.6.0.min.js',
+      CDN + 'chess.js/0.13.4/chess.min.js',
+      CDN + 'chessboard-js/1.0.0/chessboard-1.0.0.min.js'
+    ];
+    var libsReady = null;
+
+    function loadScript(src) {
+      return new Promise(function(resolve, reject) {
+        var s = document.createElement('script');
+        s.src = src;
+        s.crossOrigin = 'anonymous';
+        // async=false: скрипты качаются параллельно, но исполняются по порядку вставки
+        s.async = false;
+        s.onload = resolve;
+        s.onerror = function() { reject(new Error('Failed to load ' + src)); };
+        document.head.appendChild(s);
+      });
+    }
+
+    // библиотеки грузятся один раз и только когда пользователь открыл тренажёр
+    function loadLibs() {
+      if (!libsReady) {
+        var css = document.createElement('link');
+        css.rel = 'stylesheet';
+        css.crossOrigin = 'anonymous';
+        css.href = CDN + 'chessboard-js/1.0.0/chessboard-1.0.0.min.css';
+        document.head.appendChild(css);
+        libsReady = Promise.all(LIBS.map(loadScript));
+      }
+      return libsReady;
+    }
+
+    function uciToSan(fen, uci) {
+      try {
         var g = new window.Chess();
         g.load(fen);
-        var mv = g.move({{from: uci.slice(0,2), to: uci.slice(2,4), promotion: uci[4]}});
+        var mv = g.move({from: uci.slice(0,2), to: uci.slice(2,4), promotion: uci[4]});
         return mv ? mv.san : uci;
-      }} catch (e) {{ return uci; }}
-    }}
-
-    var cards = Array.from(document.querySelectorAll('.card.tactic'));
-    for (var i = 0; i < cards.length; i++) {{
-      (function() {{
-        var card = cards[i];
-        var id   = card.dataset.id;
-        var fen  = card.dataset.fen;
-        var best = (card.dataset.best || '').trim().toLowerCase(); // uci
-        var bestSan = uciToSan(fen, best);
-
-        var boardDiv = document.getElementById('board-' + id);
-        var st       = document.getElementById('status-' + id);
-        var okBtn    = document.getElementById('ok-' + id);
-        var wrap     = document.getElementById('wrap-' + id);
-
-        var game = new window.Chess();
-        try {{ game.load(fen); }} catch (e) {{ console.error('Bad FEN', fen, e); return; }}
-
-        var solved = false;
-
-        var cfg = {{
-          draggable: true,
-          position: fen,
-          orientation: (game.turn() === 'w' ? 'white' : 'black'),
-          // Критично: фигуры с CDN, а не относительно страницы
-          pieceTheme: 'https://cdnjs.cloudflare.com/ajax/libs/chessboard-js/1.0.0/img/chesspieces/wikipedia/{{piece}}.png',
-          onDragStart: function(source, piece, position, orientation) {{
-            if (solved) return false;
-            if (game.game_over()) return false;
-            // запретим двигать фигуры НЕ чей ход
-            if ((game.turn() === 'w' && piece[0] === 'b') ||
-                (game.turn() === 'b' && piece[0] === 'w')) {{
-              return false;
-            }}
-          }},
-          onDrop: function(source, target) {{
-            if (solved) return 'snapback';
-
-            var move = game.move({{from: source, to: target, promotion: 'q'}});
-            if (move === null) {{
-              st.textContent = 'Нелегальный ход';
-              st.className = 'status bad';
-              return 'snapback';
-            }}
-
-            var playedUci = (source + target + (move.promotion || '')).toLowerCase();
-
-            if (playedUci !== best) {{
-              // неверно — откат
-              game.undo();
-              st.textContent = '❌ Неверно. Попробуй ещё.';
-              st.className = 'status bad';
-              // вибро-эффект
-              wrap.classList.remove('shake'); void wrap.offsetWidth; wrap.classList.add('shake');
-              return 'snapback';
-            }}
-
-            // верно
-            solved = true;
-            st.textContent = '✅ Верно: ' + (move.san || bestSan);
-            st.className = 'status good';
-            okBtn.style.display = 'inline-block';
-          }},
-          onSnapEnd: function() {{
-            // cинхронизируем отображение с логикой (например, после взятия)
-            board.position(game.fen());
-          }}
-        }};
-
-        var board = window.Chessboard(boardDiv, cfg);
-      }})();
-    }}
-  }})();
+      } catch (e) { return uci; }
+    }
+
+    function initCard(card) {
+      var fen  = card.dataset.fen;
+      var best = (card.dataset.best || '').trim().toLowerCase(); // uci
+      var bestSan = uciToSan(fen, best);
+
+      // узлы ищутся внутри карточки — глобальные id на каждую карточку не нужны
+      var boardDiv = card.querySelector('.board');
+      var st       = card.querySelector('.status');
+      var okBtn    = card.querySelector('.ok');
+      var wrap     = card.querySelector('.board-wrap');
+
+      var game = new window.Chess();
+      try { game.load(fen); } catch (e) { console.error('Bad FEN', fen, e); return; }
+
+      boardDiv.innerHTML = '';  // статичный SVG заменяется живой доской
+
+      var solved = false;
+
+      var cfg = {
+        draggable: true,
+        position: fen,
+        orientation: (game.turn() === 'w' ? 'white' : 'black'),
+        // Критично: фигуры с CDN, а не относительно страницы
+        pieceTheme: 'https://cdnjs.cloudflare.com/ajax/libs/chessboard-js/1.0.0/img/chesspieces/wikipedia/{piece}.png',
+        onDragStart: function(source, piece, position, orientation) {
+          if (solved) return false;
+          if (game.game_over()) return false;
+          // запретим двигать фигуры НЕ чей ход
+          if ((game.turn() === 'w' && piece[0] === 'b') ||
+              (game.turn() === 'b' && piece[0] === 'w')) {
+            return false;
+          }
+        },
+        onDrop: function(source, target) {
+          if (solved) return 'snapback';
+
+          var move = game.move({from: source, to: target, promotion: 'q'});
+          if (move === null) {
+            st.textContent = 'Нелегальный ход';
+            st.className = 'status bad';
+            return 'snapback';
+          }
+
+          var playedUci = (source + target + (move.promotion || '')).toLowerCase();
+
+          if (playedUci !== best) {
+            // неверно — откат
+            game.undo();
+            st.textContent = '❌ Неверно. Попробуй ещё.';
+            st.className = 'status bad';
+            // вибро-эффект
+            wrap.classList.remove('shake'); void wrap.offsetWidth; wrap.classList.add('shake');
+            return 'snapback';
+          }
+
+          // верно
+          solved = true;
+          st.textContent = '✅ Верно: ' + (move.san || bestSan);
+          st.className = 'status good';
+          okBtn.style.display = 'inline-block';
+        },
+        onSnapEnd: function() {
+          // cинхронизируем отображение с логикой (например, после взятия)
+          board.position(game.fen());
+        }
+      };
+
+      var board = window.Chessboard(boardDiv, cfg);
+    }
+
+    document.getElementById('grid').addEventListener('click', function(ev) {
+      var btn = ev.target.closest('.train');
+      if (!btn) return;
+      btn.disabled = true;
+      loadLibs().then(function() {
+        btn.style.display = 'none';
+        initCard(btn.closest('.card.tactic'));
+      }).catch(function(e) {
+        btn.disabled = false;
+        console.error(e);
+      });
+    });
+  })();
   </script>
 </body>
 </html>
 """
-        return html
 
 
 # ----------------------------- CLI --------------------------------------------
@@ -435,18 +1060,34 @@ class Analyzer:
 def main():
     p = argparse.ArgumentParser(description="Lichess Error Gallery + Trainer")
     p.add_argument("--user", required=True, help="Lichess username")
-    p.add_argument("--token", default=os.environ.get("LICHESS_TOKEN", ""), help="Lichess API token (optional)")
+    p.add_argument("--verify-user", action="store_true",
+                   help="check the account with a separate request before downloading")
+    p.add_argument("--token", default=_TOKEN_DEFAULT, help="Lichess API token (optional)")
     p.add_argument("--out", default="out", help="Output directory")
-    p.add_argument("--max-games", type=int, default=int(env("MAX_GAMES", "10")))
+    p.add_argument("--max-games", type=int, default=_MAX_GAMES_DEFAULT)
     p.add_argument("--since", help="YYYY-MM-DD")
     p.add_argument("--until", help="YYYY-MM-DD")
     p.add_argument("--perf", help="comma: bullet,blitz,rapid,classical,correspondence")
-    p.add_argument("--depth", type=int, default=int(env("DEPTH", "12")))
-    p.add_argument("--threads", type=int, default=2)
-    p.add_argument("--hash-mb", type=int, default=256)
-    p.add_argument("--min-cp", type=int, default=int(env("MIN_CP", "50")))
-    p.add_argument("--mistake", type=int, default=int(env("MISTAKE", "150")))
-    p.add_argument("--blunder", type=int, default=int(env("BLUNDER", "300")))
+    p.add_argument("--color", choices=("white", "black"), help="only games where the user played this colour")
+    p.add_argument("--depth", type=int, default=_DEPTH_DEFAULT)
+    p.add_argument("--nodes", type=int, default=None, help="node limit per search (whichever of depth/nodes hits first)")
+    p.add_argument("--multipv", type=int, default=2, help="PV lines per search; the played move is looked up among them")
+    p.add_argument("--screen-depth", type=int, default=10,
+                   help="cheap pre-filter depth; only moves losing ground there get the full --depth search")
+    p.add_argument("--screen-margin", type=int, default=None,
+                   help="cp the pre-filter may underestimate a loss by (default: half of --min-cp)")
+    p.add_argument("--threads", type=int, default=1, help="Stockfish threads per worker")
+    p.add_argument("--hash-mb", type=int, default=None,
+                   help=f"total Stockfish hash, split evenly between workers (default: {_HASH_PER_WORKER_MB} MB per worker)")
+    p.add_argument("--workers", type=int, default=0, help="parallel Stockfish workers (0 = CPU count / threads)")
+    p.add_argument("--min-cp", type=int, default=_MIN_CP_DEFAULT)
+    p.add_argument("--mistake", type=int, default=_MISTAKE_DEFAULT)
+    p.add_argument("--blunder", type=int, default=_BLUNDER_DEFAULT)
+    p.add_argument("--cache", default=str(default_cache_path()), help="evaluation cache file (SQLite), kept between runs")
+    p.add_argument("--no-cache", action="store_true", help="do not read or write the evaluation cache")
+    p.add_argument("--skip-plies", type=int, default=8, help="do not analyse the first N plies (book moves)")
+    p.add_argument("--skip-pieces", type=int, default=0,
+                   help="do not analyse positions with N or fewer pieces incl. kings (0 = analyse all)")
     args = p.parse_args()
 
     thresholds = {"inaccuracy": max(0, args.min_cp), "mistake": args.mistake, "blunder": args.blunder}
@@ -465,20 +1106,20 @@ def main():
         hash_mb=args.hash_mb,
         thresholds=thresholds,
         min_cp_show=args.min_cp,
+        opening_skip_plies=max(0, args.skip_plies),
+        workers=args.workers,
+        cache_path=None if args.no_cache else args.cache,
+        nodes=args.nodes,
+        multipv=args.multipv,
+        screen_depth=args.screen_depth,
+        screen_margin=args.screen_margin,
+        verify_user=args.verify_user,
+        skip_pieces=max(0, args.skip_pieces),
+        color=args.color,
     )
 
-    try:
-        pgns = analyzer.fetch_pgns()
-        analyzed: List[Dict[str, Any]] = []
-        for idx, pgn in enumerate(pgns, 1):
-            print(f"[{idx}/{len(pgns)}] Analyzing...", file=sys.stderr)
-            try:
-                analyzed.append(analyzer.analyze_pgn(pgn))
-            except Exception as e:
-                print(f"  Skipped game due to error: {e}", file=sys.stderr)
-        analyzer.render_gallery(analyzed)
-    finally:
-        analyzer.close()
+    analyzed = analyzer.analyze_all(analyzer.iter_pgns())
+    analyzer.render_gallery(analyzed)
 
 
 if __name__ == "__main__":